@@ -4,66 +4,205 @@ Caches embeddings and search results to reduce API calls and improve response ti
 """
 import os
 import json
+import atexit
+import sqlite3
 import hashlib
+import threading
 import time
-from typing import Optional, Dict, Any, List
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple
 from pathlib import Path
 
+import numpy as np
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Embeddings are stored as packed float16 by default; the round-trip error is
+# far below cosine-similarity retrieval noise and entries are half the size of
+# float32. Callers that re-use vectors verbatim (ingestion) store float32.
+EMBEDDING_KINDS = {
+    "embedding_f16": np.float16,
+    "embedding_f32": np.float32,
+}
+
 
 class QueryCache:
-    """Simple file-based cache for query embeddings and results."""
+    """SQLite-backed cache for query embeddings and results."""
     
-    def __init__(self, cache_file: str = ".cache/query_cache.json", ttl: int = 3600):
+    def __init__(self, cache_file: str = ".cache/query_cache.db", ttl: int = 3600,
+                 memory_size: int = 512):
         """
         Initialize cache.
         
         Args:
-            cache_file: Path to cache file
+            cache_file: Path to SQLite cache file
             ttl: Time to live in seconds (default: 1 hour)
+            memory_size: Max decoded entries kept in the in-memory LRU layer
         """
         self.cache_file = Path(cache_file)
         self.ttl = ttl
-        self.cache: Dict[str, Dict[str, Any]] = {}
+        self.memory_size = memory_size
+        # In-memory LRU in front of SQLite: key -> (timestamp, decoded value)
+        self._mem: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self.conn: Optional[sqlite3.Connection] = None
+        # One connection shared across threads (e.g. parallel ingestion)
+        self._lock = threading.RLock()
+        # Writes are buffered in memory (key -> (kind, payload, ts)) and
+        # flushed in one short transaction every _dirty_threshold sets, once
+        # the oldest pending row is _flush_interval seconds old, and at exit.
+        # No write transaction stays open between calls, so other processes
+        # sharing the file are never locked out.
+        self._pending: Dict[str, Tuple[str, bytes, float]] = {}
+        self._pending_since = 0.0
+        self._dirty_threshold = 32
+        self._flush_interval = 5.0
         self._load_cache()
+        atexit.register(self._save_cache)
     
     def _load_cache(self):
-        """Load cache from disk."""
-        if self.cache_file.exists():
+        """Open the cache database, replacing an unreadable file if needed."""
+        try:
+            self._connect()
+        except sqlite3.DatabaseError as e:
+            if isinstance(e, sqlite3.OperationalError):
+                print(f"Warning: Could not load cache: {e}")
+                self.conn = None
+                return
+            # Not a SQLite file (e.g. a legacy JSON cache) or corrupted: move it
+            # aside atomically and start fresh rather than running uncached.
+            print(f"Warning: Could not load cache: {e}; starting a new cache")
             try:
-                with open(self.cache_file, 'r', encoding='utf-8') as f:
-                    self.cache = json.load(f)
-                # Clean expired entries on load
-                self._clean_expired()
-            except (json.JSONDecodeError, IOError) as e:
+                self.conn.close()
+                backup = self.cache_file.with_suffix(self.cache_file.suffix + ".bak")
+                os.replace(self.cache_file, backup)
+                self._connect()
+            except (sqlite3.Error, OSError) as e:
                 print(f"Warning: Could not load cache: {e}")
-                self.cache = {}
+                self.conn = None
+        except OSError as e:
+            print(f"Warning: Could not load cache: {e}")
+            self.conn = None
+    
+    def _connect(self):
+        """Open the SQLite connection and create the schema if needed."""
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.cache_file), isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA mmap_size=268435456;
+            PRAGMA cache_size=-8000;
+            CREATE TABLE IF NOT EXISTS cache(
+                key TEXT PRIMARY KEY,
+                kind TEXT,
+                payload BLOB,
+                ts REAL
+            );
+            CREATE INDEX IF NOT EXISTS cache_ts ON cache(ts);
+            """
+        )
+        # Clean expired entries on load
+        self._clean_expired()
     
     def _save_cache(self):
-        """Save cache to disk."""
-        try:
-            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
-            with open(self.cache_file, 'w', encoding='utf-8') as f:
-                json.dump(self.cache, f, indent=2)
-        except IOError as e:
-            print(f"Warning: Could not save cache: {e}")
+        """Commit pending writes to disk."""
+        with self._lock:
+            if self.conn is None or not self._pending:
+                return
+            rows = [(key, kind, payload, ts)
+                    for key, (kind, payload, ts) in self._pending.items()]
+            self._pending.clear()
+            try:
+                self.conn.execute("BEGIN")
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO cache(key, kind, payload, ts) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                self.conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                print(f"Warning: Could not save cache: {e}")
+    
+    def _mem_get(self, cache_key: str) -> Optional[Any]:
+        """Return a decoded value from the in-memory layer, if fresh."""
+        with self._lock:
+            entry = self._mem.get(cache_key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl:
+                del self._mem[cache_key]
+                return None
+            self._mem.move_to_end(cache_key)
+            return entry[1]
+    
+    def _mem_put(self, cache_key: str, value: Any, ts: float):
+        """Insert a decoded value written at `ts` into the in-memory layer, evicting the oldest."""
+        if self.memory_size <= 0:
+            return
+        with self._lock:
+            self._mem[cache_key] = (ts, value)
+            self._mem.move_to_end(cache_key)
+            while len(self._mem) > self.memory_size:
+                self._mem.popitem(last=False)
+    
+    def _get(self, cache_key: str, *kinds: str) -> Optional[Tuple[str, bytes, float]]:
+        """Fetch a non-expired (kind, payload, timestamp) of one of the given kinds by key."""
+        with self._lock:
+            pending = self._pending.get(cache_key)
+            if pending is not None and pending[0] in kinds:
+                return pending if time.time() - pending[2] <= self.ttl else None
+            if self.conn is None:
+                return None
+            placeholders = ", ".join("?" * len(kinds))
+            try:
+                row = self.conn.execute(
+                    f"SELECT kind, payload, ts FROM cache WHERE key = ? AND kind IN ({placeholders}) AND ts > ?",
+                    (cache_key, *kinds, time.time() - self.ttl),
+                ).fetchone()
+            except sqlite3.Error as e:
+                print(f"Warning: Could not read cache: {e}")
+                return None
+        return tuple(row) if row else None
+    
+    def _set(self, cache_key: str, kind: str, payload: bytes):
+        """Queue a single cache row for the next flush."""
+        with self._lock:
+            if self.conn is None:
+                return
+            now = time.time()
+            if not self._pending:
+                self._pending_since = now
+            self._pending[cache_key] = (kind, payload, now)
+            if (len(self._pending) >= self._dirty_threshold
+                    or now - self._pending_since >= self._flush_interval):
+                self._save_cache()
     
     def _clean_expired(self):
         """Remove expired entries from cache."""
-        current_time = time.time()
-        expired_keys = [
-            key for key, value in self.cache.items()
-            if current_time - value.get('timestamp', 0) > self.ttl
-        ]
-        for key in expired_keys:
-            del self.cache[key]
-        
-        if expired_keys:
-            self._save_cache()
+        if self.conn is None:
+            return
+        try:
+            self.conn.execute("DELETE FROM cache WHERE ts <= ?", (time.time() - self.ttl,))
+        except sqlite3.OperationalError as e:
+            # Another process holds the write lock; expired rows are already
+            # filtered out on read, so skip the sweep this time.
+            print(f"Warning: Could not clean cache: {e}")
     
     def _hash_query(self, query: str, model: str = "") -> str:
         """Generate cache key from query and model."""
         key = f"{query}:{model}".encode('utf-8')
-        return hashlib.sha256(key).hexdigest()
+        if xxhash is not None:
+            return xxhash.xxh3_128(key).hexdigest()
+        return hashlib.blake2b(key, digest_size=16).hexdigest()
     
     def get_embedding(self, query: str, model: str = "nomic-embed-text") -> Optional[List[float]]:
         """
@@ -77,19 +216,20 @@ class QueryCache:
             Cached embedding or None if not found/expired
         """
         cache_key = self._hash_query(query, model)
+        embedding = self._mem_get(cache_key)
+        if embedding is not None:
+            return embedding
         
-        if cache_key in self.cache:
-            entry = self.cache[cache_key]
-            # Check if expired
-            if time.time() - entry.get('timestamp', 0) <= self.ttl:
-                return entry.get('embedding')
-            else:
-                # Remove expired entry
-                del self.cache[cache_key]
-        
-        return None
+        row = self._get(cache_key, *EMBEDDING_KINDS)
+        if row is None:
+            return None
+        kind, buf, ts = row
+        embedding = np.frombuffer(buf, dtype=EMBEDDING_KINDS[kind]).astype(np.float32).tolist()
+        self._mem_put(cache_key, embedding, ts)
+        return embedding
     
-    def set_embedding(self, query: str, embedding: List[float], model: str = "nomic-embed-text"):
+    def set_embedding(self, query: str, embedding: List[float], model: str = "nomic-embed-text",
+                      full_precision: bool = False):
         """
         Cache an embedding for a query.
         
@@ -97,15 +237,14 @@ class QueryCache:
             query: Query text
             embedding: Embedding vector
             model: Embedding model name
+            full_precision: Store float32 instead of float16
         """
         cache_key = self._hash_query(query, model)
-        self.cache[cache_key] = {
-            'query': query,
-            'model': model,
-            'embedding': embedding,
-            'timestamp': time.time()
-        }
-        self._save_cache()
+        kind = "embedding_f32" if full_precision else "embedding_f16"
+        buf = np.asarray(embedding, dtype=EMBEDDING_KINDS[kind])
+        self._set(cache_key, kind, buf.tobytes())
+        # Keep the same rounded values a later disk hit would return
+        self._mem_put(cache_key, buf.astype(np.float32).tolist(), time.time())
     
     def get_search_results(self, query: str, limit: int = 5) -> Optional[List[Dict[str, Any]]]:
         """
@@ -119,17 +258,17 @@ class QueryCache:
             Cached search results or None if not found/expired
         """
         cache_key = self._hash_query(f"search:{query}:{limit}", "")
+        results = self._mem_get(cache_key)
+        if results is not None:
+            return results
         
-        if cache_key in self.cache:
-            entry = self.cache[cache_key]
-            # Check if expired
-            if time.time() - entry.get('timestamp', 0) <= self.ttl:
-                return entry.get('results')
-            else:
-                # Remove expired entry
-                del self.cache[cache_key]
-        
-        return None
+        row = self._get(cache_key, 'results')
+        if row is None:
+            return None
+        _, buf, ts = row
+        results = orjson.loads(buf) if orjson is not None else json.loads(buf)
+        self._mem_put(cache_key, results, ts)
+        return results
     
     def set_search_results(self, query: str, results: List[Dict[str, Any]], limit: int = 5):
         """
@@ -141,27 +280,33 @@ class QueryCache:
             limit: Number of results
         """
         cache_key = self._hash_query(f"search:{query}:{limit}", "")
-        self.cache[cache_key] = {
-            'query': query,
-            'limit': limit,
-            'results': results,
-            'timestamp': time.time()
-        }
-        self._save_cache()
+        if orjson is not None:
+            buf = orjson.dumps(results, option=orjson.OPT_SERIALIZE_NUMPY)
+        else:
+            buf = json.dumps(results).encode('utf-8')
+        self._set(cache_key, 'results', buf)
+        self._mem_put(cache_key, results, time.time())
     
     def clear(self):
         """Clear all cache entries."""
-        self.cache = {}
-        self._save_cache()
+        with self._lock:
+            self._mem.clear()
+            self._pending.clear()
+            if self.conn is None:
+                return
+            self.conn.execute("DELETE FROM cache")
     
     def get_stats(self) -> Dict[str, Any]:
         """Get cache statistics."""
-        current_time = time.time()
-        total_entries = len(self.cache)
-        expired_entries = sum(
-            1 for entry in self.cache.values()
-            if current_time - entry.get('timestamp', 0) > self.ttl
-        )
+        total_entries = 0
+        expired_entries = 0
+        with self._lock:
+            self._save_cache()
+            if self.conn is not None:
+                total_entries, expired_entries = self.conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(ts <= ?), 0) FROM cache",
+                    (time.time() - self.ttl,),
+                ).fetchone()
         
         return {
             'total_entries': total_entries,
@@ -174,6 +319,7 @@ class QueryCache:
 
 # Global cache instance
 _cache_instance: Optional[QueryCache] = None
+_cache_instance_lock = threading.Lock()
 
 
 def get_cache(cache_file: str = None, ttl: int = None) -> QueryCache:
@@ -190,9 +336,11 @@ def get_cache(cache_file: str = None, ttl: int = None) -> QueryCache:
     global _cache_instance
     
     if _cache_instance is None:
-        cache_file = cache_file or os.getenv('CACHE_FILE', '.cache/query_cache.json')
-        ttl = ttl or int(os.getenv('CACHE_TTL', '3600'))
-        _cache_instance = QueryCache(cache_file, ttl)
+        with _cache_instance_lock:
+            if _cache_instance is None:
+                cache_file = cache_file or os.getenv('CACHE_FILE', '.cache/query_cache.db')
+                ttl = ttl or int(os.getenv('CACHE_TTL', '3600'))
+                _cache_instance = QueryCache(cache_file, ttl)
     
     return _cache_instance
 
@@ -208,5 +356,6 @@ if __name__ == "__main__":
     cache.set_embedding(test_query, test_embedding)
     retrieved = cache.get_embedding(test_query)
     
-    print(f"Cache test: {'PASSED' if retrieved == test_embedding else 'FAILED'}")
+    passed = retrieved is not None and np.allclose(retrieved, test_embedding, atol=1e-3)
+    print(f"Cache test: {'PASSED' if passed else 'FAILED'}")
     print(f"Stats: {cache.get_stats()}")
@@ -1,11 +1,15 @@
 import os
 import glob
+import mmap
+import re
 import uuid
 import json
 import time
-from typing import List, Dict, Any
+from itertools import islice
+from typing import List, Dict, Any, Iterable, Iterator, Tuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import numpy as np
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
@@ -14,25 +18,77 @@ try:
     from tqdm import tqdm
 except ImportError:
     tqdm = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    from qdrant_client import QdrantClient
+    from qdrant_client.http.models import PointStruct
+except ImportError:
+    QdrantClient = None
+
+# Import cache if available
+try:
+    from cache import get_cache
+    CACHE_AVAILABLE = True
+except ImportError:
+    CACHE_AVAILABLE = False
 
 load_dotenv()
 
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
 QDRANT_URL = os.getenv("QDRANT_URL", "http://localhost:6333")
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", "6334"))
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() == "true"
 COLLECTION = os.getenv("QDRANT_COLLECTION", "heritage_transcripts")
 VECTOR_SIZE = int(os.getenv("QDRANT_VECTOR_SIZE", "768"))
-DISTANCE = os.getenv("QDRANT_DISTANCE", "Cosine")
+DISTANCE = os.getenv("QDRANT_DISTANCE", "Dot")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
 DATA_DIR = os.path.join(os.getcwd(), "data", "transcripts")
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", "10"))
 MAX_WORKERS = int(os.getenv("MAX_WORKERS", "4"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+ENABLE_CACHE = os.getenv("ENABLE_CACHE", "true").lower() == "true"
 
 HEADERS_JSON = {"Content-Type": "application/json"}
 
+# Point IDs are derived from (file, chunk_index) so re-ingesting a file
+# overwrites its points instead of adding duplicates.
+POINT_ID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "tunisian-heritage/points")
+
+
+def json_dumps(obj: Any) -> bytes:
+    """Encode a request body, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+def normalize(vectors: Any) -> np.ndarray:
+    """L2-normalize one vector or a matrix of row vectors (float32)."""
+    arr = np.asarray(vectors, dtype=np.float32)
+    return arr / (np.linalg.norm(arr, axis=-1, keepdims=True) + 1e-12)
+
+
+class RateLimitRetry(Retry):
+    """Retry policy that also retries POST, but only on HTTP 429.
+    
+    POSTs (embeddings, search, generation) are not retried on timeouts,
+    dropped connections or 5xx, so a slow request is never re-run; a 429
+    means the server rejected it without doing the work.
+    """
+    
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method and method.upper() == "POST":
+            return status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
+
+
 # Setup session with connection pooling and retries
 def create_session() -> requests.Session:
     session = requests.Session()
-    retry_strategy = Retry(
+    retry_strategy = RateLimitRetry(
         total=3,
         backoff_factor=1,
         status_forcelist=[429, 500, 502, 503, 504],
@@ -45,6 +101,17 @@ def create_session() -> requests.Session:
 SESSION = create_session()
 
 
+def create_qdrant_client():
+    """Create a gRPC Qdrant client for upserts, if qdrant-client is installed."""
+    if QdrantClient is None or not QDRANT_PREFER_GRPC:
+        return None
+    return QdrantClient(url=QDRANT_URL, grpc_port=QDRANT_GRPC_PORT, prefer_grpc=True,
+                        check_compatibility=False)
+
+# Binary protobuf upserts avoid stringifying every float; REST is the fallback
+QDRANT_CLIENT = create_qdrant_client()
+
+
 def ensure_collection():
     """Check if collection exists, create if not."""
     try:
@@ -68,46 +135,109 @@ def ensure_collection():
         "hnsw_config": {
             "m": 16,
             "ef_construct": 100
+        },
+        # int8 copy of the vectors kept in RAM for HNSW traversal (4x smaller);
+        # queries rescore the top candidates against the original vectors
+        "quantization_config": {
+            "scalar": {
+                "type": "int8",
+                "quantile": 0.99,
+                "always_ram": True
+            }
         }
     }
     r = SESSION.put(f"{QDRANT_URL}/collections/{COLLECTION}", headers=HEADERS_JSON, 
-                    data=json.dumps(payload), timeout=10)
+                    data=json_dumps(payload), timeout=10)
     r.raise_for_status()
-    print(f"✓ Created collection '{COLLECTION}' with optimized HNSW config.")
+    print(f"✓ Created collection '{COLLECTION}' with optimized HNSW and int8 quantization config.")
+
+
+# A paragraph is a run of non-empty lines separated by single newlines
+_PARA_RE = re.compile(r"[^\n]+(?:\n(?!\n)[^\n]+)*")
+
+
+def paragraph_spans(text: str) -> List[Tuple[int, int]]:
+    """Return (start, end) offsets of the stripped, non-empty paragraphs in text."""
+    spans = []
+    for m in _PARA_RE.finditer(text):
+        start, end = m.span()
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start < end:
+            spans.append((start, end))
+    return spans
 
 
 def chunk_text(text: str, max_chars: int = 600, overlap: int = 50) -> List[str]:
-    """Chunk text into paragraphs with optional overlap for better context."""
-    paras = [p.strip() for p in text.split("\n\n") if p.strip()]
+    """Chunk text into paragraphs with optional overlap for better context.
+    
+    Paragraphs are packed greedily; each costs its length plus the 2-char
+    separator. Cut points come from a prefix sum of those costs, so each
+    chunk boundary is one np.searchsorted call instead of a per-paragraph loop.
+    Paragraphs are tracked as offsets into text and only sliced when a chunk
+    is joined.
+    """
+    spans = paragraph_spans(text)
+    if not spans:
+        return []
+    
+    n = len(spans)
+    lengths = np.fromiter((e - s for s, e in spans), dtype=np.int64, count=n)
+    cum = np.cumsum(lengths + 2)
     chunks = []
-    buf = []
-    total = 0
+    start = 0
     
-    for p in paras:
-        p_len = len(p)
-        if total + p_len + 2 <= max_chars:
-            buf.append(p)
-            total += p_len + 2
+    while start < n:
+        base = cum[start - 1] if start else 0
+        end = int(np.searchsorted(cum, base + max_chars, side="right"))
+        # Single paragraph too large, emit it on its own
+        end = max(end, start + 1)
+        chunks.append("\n\n".join(text[s:e] for s, e in spans[start:end]))
+        if end >= n:
+            break
+        # Keep last paragraph for overlap if it's small enough and still
+        # leaves room for the next paragraph
+        last = end - 1
+        if (overlap > 0 and last > start and lengths[last] <= overlap
+                and cum[end] - (cum[last - 1] if last else 0) <= max_chars):
+            start = last
         else:
-            if buf:
-                chunk = "\n\n".join(buf)
-                chunks.append(chunk)
-                # Keep last paragraph for overlap if it's small enough
-                if overlap > 0 and len(buf[-1]) <= overlap:
-                    buf = [buf[-1], p]
-                    total = len(buf[-1]) + p_len + 2
-                else:
-                    buf = [p]
-                    total = p_len
-            else:
-                # Single paragraph too large, split by sentences
-                chunks.append(p)
-                buf = []
-                total = 0
-    if buf:
-        chunks.append("\n\n".join(buf))
+            start = end
     
-    return [c for c in chunks if c.strip()]
+    return chunks
+
+
+def _normalize_newlines(text: str) -> str:
+    """Convert CRLF/CR line endings to LF, as text-mode open() would."""
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def read_transcript(path: str) -> Tuple[Dict[str, str], str]:
+    """Read a transcript, returning its front-matter metadata and body.
+    
+    The file is memory-mapped so the front-matter delimiters are located with
+    a C-level scan and only the metadata and body slices are decoded.
+    """
+    meta = {}
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return meta, ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            body_start = 0
+            if mm[:3] == b"---":
+                fm_end = mm.find(b"---", 3)
+                if fm_end != -1:
+                    fm = _normalize_newlines(mm[3:fm_end].decode("utf-8")).strip()
+                    for line in fm.splitlines():
+                        if ":" in line:
+                            k, v = line.split(":", 1)
+                            meta[k.strip()] = v.strip().strip('"').strip("'")
+                    body_start = fm_end + 3
+            body = _normalize_newlines(mm[body_start:].decode("utf-8"))
+    
+    return meta, body.strip() if body_start else body
 
 
 def embed(text: str) -> List[float]:
@@ -115,16 +245,26 @@ def embed(text: str) -> List[float]:
     try:
         payload = {"model": EMBED_MODEL, "prompt": text}
         r = SESSION.post(f"{OLLAMA_URL}/api/embeddings", headers=HEADERS_JSON, 
-                        data=json.dumps(payload), timeout=30)
+                        data=json_dumps(payload), timeout=30)
         r.raise_for_status()
         data = r.json()
-        return data.get("embedding")
+        # Unit-length vectors let Qdrant use plain dot product instead of cosine
+        return normalize(data.get("embedding")).tolist()
     except requests.exceptions.RequestException as e:
         print(f"Error embedding text: {e}")
         raise
 
-def embed_batch(texts: List[str]) -> List[List[float]]:
-    """Generate embeddings in parallel for better throughput."""
+def embed_many(texts: List[str]) -> List[List[float]]:
+    """Generate embeddings for several texts in a single Ollama request."""
+    payload = {"model": EMBED_MODEL, "input": texts}
+    r = SESSION.post(f"{OLLAMA_URL}/api/embed", headers=HEADERS_JSON,
+                    data=json_dumps(payload), timeout=120)
+    r.raise_for_status()
+    return normalize(r.json().get("embeddings")).tolist()
+
+
+def embed_parallel(texts: List[str]) -> List[List[float]]:
+    """Generate embeddings one request per text, spread over worker threads."""
     embeddings = []
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
         future_to_idx = {executor.submit(embed, text): i for i, text in enumerate(texts)}
@@ -140,6 +280,56 @@ def embed_batch(texts: List[str]) -> List[List[float]]:
     return [emb for _, emb in embeddings]
 
 
+def embed_batch(texts: List[str]) -> List[List[float]]:
+    """Generate embeddings in sub-batches via Ollama's batched /api/embed endpoint."""
+    embeddings = []
+    for i in range(0, len(texts), EMBED_BATCH_SIZE):
+        sub = texts[i:i + EMBED_BATCH_SIZE]
+        try:
+            embeddings.extend(embed_many(sub))
+        except requests.exceptions.HTTPError as e:
+            # Older Ollama versions only provide the single-prompt endpoint
+            if e.response is not None and e.response.status_code in (400, 404):
+                embeddings.extend(embed_parallel(sub))
+            else:
+                print(f"Failed to embed chunks {i}-{i + len(sub) - 1}: {e}")
+                embeddings.extend([None] * len(sub))
+        except requests.exceptions.RequestException as e:
+            print(f"Failed to embed chunks {i}-{i + len(sub) - 1}: {e}")
+            embeddings.extend([None] * len(sub))
+    return embeddings
+
+
+def embed_unique(texts: List[str]) -> List[List[float]]:
+    """Embed texts, sending each distinct text to Ollama at most once.
+    
+    Repeated chunks (boilerplate, headers) are embedded once and fanned back
+    out. When the query cache is enabled, vectors are also looked up and
+    stored there so duplicates across windows and files skip Ollama too.
+    """
+    cache = get_cache() if CACHE_AVAILABLE and ENABLE_CACHE else None
+    unique = list(dict.fromkeys(texts))
+    vectors: Dict[str, List[float]] = {}
+    
+    if cache is not None:
+        for text in unique:
+            vec = cache.get_embedding(text, EMBED_MODEL)
+            if vec is not None:
+                vectors[text] = vec
+    
+    missing = [text for text in unique if text not in vectors]
+    if missing:
+        for text, vec in zip(missing, embed_batch(missing)):
+            if vec is None:
+                continue
+            vectors[text] = vec
+            if cache is not None:
+                # float32 so cache hits upsert exactly what a fresh run would
+                cache.set_embedding(text, vec, EMBED_MODEL, full_precision=True)
+    
+    return [vectors.get(text) for text in texts]
+
+
 def upsert_points(points: List[Dict[str, Any]], batch_size: int = BATCH_SIZE):
     """Upsert points in batches for better performance."""
     if not points:
@@ -147,71 +337,83 @@ def upsert_points(points: List[Dict[str, Any]], batch_size: int = BATCH_SIZE):
     
     for i in range(0, len(points), batch_size):
         batch = points[i:i + batch_size]
-        payload = {"points": batch}
         try:
-            r = SESSION.put(f"{QDRANT_URL}/collections/{COLLECTION}/points", 
-                          headers=HEADERS_JSON, data=json.dumps(payload), timeout=30)
-            r.raise_for_status()
-        except requests.exceptions.RequestException as e:
+            if QDRANT_CLIENT is not None:
+                QDRANT_CLIENT.upsert(collection_name=COLLECTION, wait=False,
+                                     points=[PointStruct(**point) for point in batch])
+            else:
+                payload = {"points": batch}
+                r = SESSION.put(f"{QDRANT_URL}/collections/{COLLECTION}/points", 
+                              headers=HEADERS_JSON, data=json_dumps(payload), timeout=30)
+                r.raise_for_status()
+        except Exception as e:
             print(f"Error upserting batch {i//batch_size + 1}: {e}")
             raise
 
 
+def batched(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Yield successive lists of at most `size` items."""
+    it = iter(items)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_point_batches(path: str, meta: Dict[str, str], chunks: List[str]) -> Iterator[List[Dict[str, Any]]]:
+    """Embed chunks one window at a time and yield the resulting points per window."""
+    offset = 0
+    for window in batched(chunks, EMBED_BATCH_SIZE):
+        embeddings = embed_unique(window)
+        points = []
+        for idx, (ch, vec) in enumerate(zip(window, embeddings), offset):
+            if vec is None:
+                continue
+            point_id = str(uuid.uuid5(POINT_ID_NAMESPACE, f"{os.path.basename(path)}:{idx}"))
+            payload = {
+                "source": meta.get("source", "simulated"),
+                "title": meta.get("title", os.path.basename(path)),
+                "region": meta.get("region", None),
+                "date": meta.get("date", None),
+                "lang": meta.get("lang", None),
+                "chunk_index": idx,
+                "text": ch,
+                "file": os.path.basename(path)
+            }
+            points.append({"id": point_id, "vector": vec, "payload": payload})
+        offset += len(window)
+        if points:
+            yield points
+
+
 def ingest_file(path: str) -> int:
-    """Ingest a single file with optimized batch embedding."""
+    """Ingest a single file, overlapping embedding of each window with upsert of the previous one."""
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            content = f.read()
+        meta, body = read_transcript(path)
     except Exception as e:
         print(f"Error reading {path}: {e}")
         return 0
     
-    # Parse front-matter metadata
-    meta = {}
-    if content.startswith("---"):
-        fm_end = content.find("---", 3)
-        if fm_end != -1:
-            fm = content[3:fm_end].strip()
-            for line in fm.splitlines():
-                if ":" in line:
-                    k, v = line.split(":", 1)
-                    meta[k.strip()] = v.strip().strip('"').strip("'")
-            body = content[fm_end+3:].strip()
-        else:
-            body = content
-    else:
-        body = content
-    
     chunks = chunk_text(body)
     if not chunks:
         print(f"⚠ No chunks extracted from {os.path.basename(path)}")
         return 0
     
-    # Batch embed all chunks at once
-    embeddings = embed_batch(chunks)
-    
-    # Build points
-    points = []
-    for idx, (ch, vec) in enumerate(zip(chunks, embeddings)):
-        if vec is None:
-            continue
-        point_id = str(uuid.uuid4())
-        payload = {
-            "source": meta.get("source", "simulated"),
-            "title": meta.get("title", os.path.basename(path)),
-            "region": meta.get("region", None),
-            "date": meta.get("date", None),
-            "lang": meta.get("lang", None),
-            "chunk_index": idx,
-            "text": ch,
-            "file": os.path.basename(path)
-        }
-        points.append({"id": point_id, "vector": vec, "payload": payload})
-    
-    if points:
-        upsert_points(points)
+    # Ollama (embedding) and Qdrant (upsert) are separate services, so upsert
+    # window i in the background while the generator embeds window i+1.
+    total = 0
+    pending = None
+    with ThreadPoolExecutor(max_workers=1) as upserter:
+        for points in iter_point_batches(path, meta, chunks):
+            if pending is not None:
+                pending.result()
+            pending = upserter.submit(upsert_points, points)
+            total += len(points)
+        if pending is not None:
+            pending.result()
     
-    return len(points)
+    return total
 
 
 def main():
@@ -236,19 +438,24 @@ def main():
     total_chunks = 0
     failed_files = []
     
-    # Process files with progress bar
-    iterator = tqdm(files, desc="Processing files") if tqdm else files
-    
-    for fp in iterator:
-        try:
-            chunks = ingest_file(fp)
-            total_chunks += chunks
-            if not tqdm:
-                print(f"✓ {os.path.basename(fp)}: {chunks} chunks")
-        except Exception as e:
-            failed_files.append((fp, str(e)))
-            if not tqdm:
-                print(f"✗ {os.path.basename(fp)}: FAILED - {e}")
+    # Files are independent and mostly wait on Ollama/Qdrant, so ingest them
+    # concurrently; SESSION's connection pool is shared across threads.
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(files))) as executor:
+        future_to_file = {executor.submit(ingest_file, fp): fp for fp in files}
+        completed = as_completed(future_to_file)
+        iterator = tqdm(completed, total=len(files), desc="Processing files") if tqdm else completed
+        
+        for future in iterator:
+            fp = future_to_file[future]
+            try:
+                chunks = future.result()
+                total_chunks += chunks
+                if not tqdm:
+                    print(f"✓ {os.path.basename(fp)}: {chunks} chunks")
+            except Exception as e:
+                failed_files.append((fp, str(e)))
+                if not tqdm:
+                    print(f"✗ {os.path.basename(fp)}: FAILED - {e}")
     
     elapsed = time.time() - start_time
     
@@ -8,8 +8,15 @@ import json
 import argparse
 from typing import List, Dict, Any
 
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Import cache if available
 try:
@@ -30,6 +37,53 @@ ENABLE_CACHE = os.getenv("ENABLE_CACHE", "true").lower() == "true"
 
 HEADERS_JSON = {"Content-Type": "application/json"}
 
+# Search the int8-quantized index, then rescore 2x candidates with full vectors
+SEARCH_PARAMS = {"quantization": {"rescore": True, "oversampling": 2.0}}
+
+
+def json_dumps(obj: Any) -> bytes:
+    """Encode a request body, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+class RateLimitRetry(Retry):
+    """Retry policy that also retries POST, but only on HTTP 429.
+    
+    POSTs (embeddings, search, generation) are not retried on timeouts,
+    dropped connections or 5xx, so a slow request is never re-run; a 429
+    means the server rejected it without doing the work.
+    """
+    
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method and method.upper() == "POST":
+            return status_code == 429
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+# Setup session with connection pooling and retries
+def create_session() -> requests.Session:
+    session = requests.Session()
+    retry_strategy = RateLimitRetry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(HEADERS_JSON)
+    return session
+
+SESSION = create_session()
+
+
+def normalize(vector: List[float]) -> np.ndarray:
+    """L2-normalize a vector (float32)."""
+    arr = np.asarray(vector, dtype=np.float32)
+    return arr / (np.linalg.norm(arr) + 1e-12)
+
 
 def embed_query(query: str, use_cache: bool = True) -> List[float]:
     """
@@ -42,9 +96,10 @@ def embed_query(query: str, use_cache: bool = True) -> List[float]:
     Returns:
         Embedding vector
     """
+    cache = get_cache() if use_cache and CACHE_AVAILABLE and ENABLE_CACHE else None
+    
     # Try cache first
-    if use_cache and CACHE_AVAILABLE and ENABLE_CACHE:
-        cache = get_cache()
+    if cache is not None:
         cached_emb = cache.get_embedding(query, EMBED_MODEL)
         if cached_emb:
             print(f"✓ Using cached embedding")
@@ -52,14 +107,15 @@ def embed_query(query: str, use_cache: bool = True) -> List[float]:
     
     # Generate embedding
     payload = {"model": EMBED_MODEL, "prompt": query}
-    r = requests.post(f"{OLLAMA_URL}/api/embeddings", headers=HEADERS_JSON, 
-                     data=json.dumps(payload), timeout=30)
+    r = SESSION.post(f"{OLLAMA_URL}/api/embeddings", data=json_dumps(payload), timeout=30)
     r.raise_for_status()
     embedding = r.json().get("embedding")
+    if embedding:
+        # Match the unit-length vectors stored at ingest (Dot distance)
+        embedding = normalize(embedding).tolist()
     
     # Cache for future use
-    if use_cache and CACHE_AVAILABLE and ENABLE_CACHE and embedding:
-        cache = get_cache()
+    if cache is not None and embedding:
         cache.set_embedding(query, embedding, EMBED_MODEL)
     
     return embedding
@@ -80,10 +136,35 @@ def search_qdrant(embedding: List[float], limit: int = 5) -> List[Dict[str, Any]
         "vector": embedding,
         "limit": limit,
         "with_payload": True,
-        "with_vector": False
+        "with_vector": False,
+        "params": SEARCH_PARAMS
     }
-    r = requests.post(f"{QDRANT_URL}/collections/{COLLECTION}/points/search",
-                     headers=HEADERS_JSON, data=json.dumps(payload), timeout=30)
+    r = SESSION.post(f"{QDRANT_URL}/collections/{COLLECTION}/points/search",
+                     data=json_dumps(payload), timeout=30)
+    r.raise_for_status()
+    return r.json().get("result", [])
+
+
+def search_qdrant_batch(embeddings: List[List[float]], limit: int = 5) -> List[List[Dict[str, Any]]]:
+    """
+    Search Qdrant for several query embeddings in a single request.
+    
+    Args:
+        embeddings: Query embeddings
+        limit: Number of results per query
+        
+    Returns:
+        One list of search results per embedding, in input order
+    """
+    payload = {
+        "searches": [
+            {"vector": embedding, "limit": limit, "with_payload": True, "with_vector": False,
+             "params": SEARCH_PARAMS}
+            for embedding in embeddings
+        ]
+    }
+    r = SESSION.post(f"{QDRANT_URL}/collections/{COLLECTION}/points/search/batch",
+                     data=json_dumps(payload), timeout=30)
     r.raise_for_status()
     return r.json().get("result", [])
 
@@ -119,8 +200,7 @@ Write a concise answer, include citation snippets with source labels [#]."""
         "prompt": prompt
     }
     
-    r = requests.post(f"{OLLAMA_URL}/api/generate", headers=HEADERS_JSON,
-                     data=json.dumps(payload), timeout=60)
+    r = SESSION.post(f"{OLLAMA_URL}/api/generate", data=json_dumps(payload), timeout=60)
     r.raise_for_status()
     return r.json().get("response", "")
 
@@ -150,31 +230,19 @@ def format_context(results: List[Dict[str, Any]]) -> str:
     return "\n\n".join(context_parts)
 
 
-def query_rag(query: str, limit: int = 5, use_cache: bool = True, 
-              generate: bool = True) -> Dict[str, Any]:
+def present_results(query: str, results: List[Dict[str, Any]],
+                    generate: bool = True) -> Dict[str, Any]:
     """
-    Complete RAG query pipeline.
+    Print search results and optionally generate an answer from them.
     
     Args:
         query: User query
-        limit: Number of search results
-        use_cache: Whether to use caching
-        generate: Whether to generate answer (False for search only)
+        results: Search results from Qdrant
+        generate: Whether to generate answer
         
     Returns:
         Dictionary with results and answer
     """
-    print(f"\n🔍 Query: {query}")
-    print(f"{'='*60}")
-    
-    # Embed query
-    print(f"\n⚙️  Generating embedding...")
-    embedding = embed_query(query, use_cache=use_cache)
-    
-    # Search
-    print(f"🔎 Searching Qdrant (top {limit})...")
-    results = search_qdrant(embedding, limit=limit)
-    
     print(f"\n📚 Found {len(results)} results:")
     for idx, result in enumerate(results, 1):
         payload = result.get("payload", {})
@@ -202,6 +270,63 @@ def query_rag(query: str, limit: int = 5, use_cache: bool = True,
     return response
 
 
+def query_rag(query: str, limit: int = 5, use_cache: bool = True, 
+              generate: bool = True) -> Dict[str, Any]:
+    """
+    Complete RAG query pipeline.
+    
+    Args:
+        query: User query
+        limit: Number of search results
+        use_cache: Whether to use caching
+        generate: Whether to generate answer (False for search only)
+        
+    Returns:
+        Dictionary with results and answer
+    """
+    print(f"\n🔍 Query: {query}")
+    print(f"{'='*60}")
+    
+    # Embed query
+    print(f"\n⚙️  Generating embedding...")
+    embedding = embed_query(query, use_cache=use_cache)
+    
+    # Search
+    print(f"🔎 Searching Qdrant (top {limit})...")
+    results = search_qdrant(embedding, limit=limit)
+    
+    return present_results(query, results, generate=generate)
+
+
+def query_rag_batch(queries: List[str], limit: int = 5, use_cache: bool = True,
+                    generate: bool = True) -> List[Dict[str, Any]]:
+    """
+    RAG pipeline for several queries, retrieved with one batched Qdrant search.
+    
+    Args:
+        queries: User queries
+        limit: Number of search results per query
+        use_cache: Whether to use caching
+        generate: Whether to generate answers (False for search only)
+        
+    Returns:
+        One response dictionary per query, in input order
+    """
+    print(f"\n⚙️  Generating embeddings for {len(queries)} queries...")
+    embeddings = [embed_query(query, use_cache=use_cache) for query in queries]
+    
+    print(f"🔎 Searching Qdrant (top {limit}, batched)...")
+    all_results = search_qdrant_batch(embeddings, limit=limit)
+    
+    responses = []
+    for query, results in zip(queries, all_results):
+        print(f"\n🔍 Query: {query}")
+        print(f"{'='*60}")
+        responses.append(present_results(query, results, generate=generate))
+    
+    return responses
+
+
 def main():
     """Main CLI interface."""
     parser = argparse.ArgumentParser(description="Query Tunisian Heritage RAG")
@@ -214,6 +339,8 @@ def main():
                        help="Only search, don't generate answer")
     parser.add_argument("-i", "--interactive", action="store_true",
                        help="Interactive mode")
+    parser.add_argument("-f", "--queries-file",
+                       help="File with one query per line, searched in a single batch")
     parser.add_argument("--cache-stats", action="store_true",
                        help="Show cache statistics")
     parser.add_argument("--clear-cache", action="store_true",
@@ -239,6 +366,23 @@ def main():
         print("✓ Cache cleared")
         return
     
+    # Batch mode
+    if args.queries_file:
+        try:
+            with open(args.queries_file, "r", encoding="utf-8") as f:
+                queries = [line.strip() for line in f if line.strip()]
+            if queries:
+                query_rag_batch(
+                    queries,
+                    limit=args.limit,
+                    use_cache=not args.no_cache,
+                    generate=not args.search_only
+                )
+        except Exception as e:
+            print(f"\n❌ Error: {e}")
+            sys.exit(1)
+        return
+    
     # Interactive mode
     if args.interactive:
         print("🎯 Interactive Query Mode (type 'quit' to exit)\n")